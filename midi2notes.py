@@ -1,10 +1,13 @@
 #!/usr/bin/python
 
 from __future__ import print_function
-import argparse, os, collections, bisect, platform
+import argparse, os, sys, collections, bisect, platform, struct, math
 import mido
 from itertools import islice
-from fractions import gcd
+try:
+    from math import gcd
+except ImportError:
+    from fractions import gcd
 from glob import glob
 import functools
 
@@ -31,14 +34,46 @@ duration_strings = [
 
 value_dict = {"":"", "NRS": 0}
 
+#Length of each duration_strings entry in units of the multiplier (ms), mirrors audio_duration[]
+duration_units = [2, 3, 4, 6, 8, 9, 12, 16, 18, 24, 36, 48]
+
+#Rough avr-gcc cost (cycles) of the pieces of CAudio::InterruptMultipleStreams(), tune as needed
+isr_cpu = 16000000      #F_CPU
+isr_frequency = 64000   #CAudio::FREQUENCY
+isr_endpoints = 3       #CAudio::COUNT
+#ms per tock(), count++ >= FREQUENCY/1000 runs every 65th match and CTC with OCR1A = F_CPU/FREQUENCY
+# matches every 251 cycles
+isr_tock = (isr_frequency // 1000 + 1) * (isr_cpu // isr_frequency + 1) * 1000.0 / isr_cpu
+isr_cycles = {
+    "Overhead": 45,     #prologue/epilogue and call through g_callback_object
+    "Tick": 14,         #per endpoint period countdown and pin toggle
+    "Tock": 12,         #per endpoint millisecond countdown
+    "Next": 30,         #next() call and branching
+    "StreamRead": 20,   #indirect StreamFunc call plus the read itself
+    "PgmRead": 6,       #pgm_read_word() of audio_note[] or audio_duration[]
+    "Multiply": 20,     #multiplier * duration
+    "Divide": 215,      #FREQUENCY / frequency via __udivmodhi4
+}
+isr_passage_gap = 250   #ms between flagged ticks that still count as one passage
+isr_passage_limit = 5   #passages listed without -v
+isr_max_dropped = None  #timer matches a song may drop before the run fails
+
+#SD card container, see nBlockStream.h
+sector_size = 512
+sector_magic = b"nAUD"
+sector_version = 1
+sector_latency = 5.0    #ms from a buffer being freed until loop() has read the next block into it
+sector_buffers = 2      #CBlockStream::BUFFER_COUNT
+
 verbose = 0
 noteEncountered = False
 tempoChanges = False
 totalSaved = 0
 totalBytes = 0
+workloadFailures = 0
 
 def main():
-    global verbose
+    global verbose, sector_latency, isr_max_dropped
 
     parser = argparse.ArgumentParser(description='Output clock compatible data from a midi file.')
     parser.add_argument('files', metavar='file', type=str, nargs='+',
@@ -47,11 +82,22 @@ def main():
     parser.add_argument('-o', '--output', help='File to output to')
     parser.add_argument('-j', '--json', action='store_true', help='Use JSON format')
     parser.add_argument('-c', '--channels', type=int, help='Number of channels to parse per MIDI', default=2)
+    parser.add_argument('-w', '--workload', action='store_true', help='Report estimated ISR workload of the output')
+    parser.add_argument('--max-dropped', type=int,
+                        help='Fail when a song drops more timer matches than this (implies -w)')
+    parser.add_argument('-S', '--sdcard', help='SD card container to write')
+    parser.add_argument('-L', '--latency', type=float, default=sector_latency,
+                        help='Block read latency (ms) used to size SD card buffers')
     parser.add_argument("-v", "--verbosity", action="count", default=0, help='Each use increases verbosity level')
 
     args = parser.parse_args()
     
     verbose = args.verbosity
+    sector_latency = args.latency
+    isr_max_dropped = args.max_dropped
+
+    if isr_max_dropped is not None:
+        args.workload = True
 
     if verbose > 0:
         print(args)
@@ -63,6 +109,7 @@ def main():
         outFile = None
 
     files = []
+    sectors = [] if args.sdcard else None
     
     # Fix stupid Windows non-expanding wildcard bug
     if platform.system() == 'Windows':
@@ -73,17 +120,25 @@ def main():
     
     for f in files:
         print("Now processing: " + f)
-        processFile(f, optimize=args.optimize, numChannels=args.channels, printJSON=args.json, outFile=outFile);
+        processFile(f, optimize=args.optimize, numChannels=args.channels, printJSON=args.json, outFile=outFile,
+                    workload=args.workload, sectors=sectors);
 
     if args.output:
         outFile.seek(outFile.tell() - 2 - (platform.system() == 'Windows'), os.SEEK_SET)   # os.SEEK_SET == 0
         outFile.truncate() # Remove trailing comma
         outFile.write("\n]\n")
 
+    if args.sdcard:
+        writeSectors(sectors, args.sdcard)
+
     if args.optimize and len(files) > 1:
         fmtString = 'Total bytes saved from optimization: {}/{} ({:.2f}%)'
         print(fmtString.format(totalSaved, totalBytes, (totalSaved*100.0)/totalBytes))
 
+    if workloadFailures:
+        print("ERROR: {} songs drop more than {} timer matches".format(workloadFailures, isr_max_dropped))
+        sys.exit(1)
+
 def window(seq, n=2):
     it = iter(seq)
     result = tuple(islice(it, n))
@@ -143,7 +198,8 @@ def eventSort(x, y):
         return 0
         
 
-def processFile(filename, optimize=False, numChannels=2, printJSON=False, outFile=None):
+def processFile(filename, optimize=False, numChannels=2, printJSON=False, outFile=None, workload=False,
+                sectors=None):
     global noteEncountered, tempoChanges
     if verbose > 2:
         print("Entering processFile()")
@@ -189,8 +245,9 @@ def processFile(filename, optimize=False, numChannels=2, printJSON=False, outFil
 
     uspq = channels[0].get("Tempo", 500000)
     tsD = channels[0].get("TimeSignature", 4.0)
+    tempoMap = channels[0].get("TempoMap", [])
 
-    multiplier = calculateTiming(channels, pattern.ticks_per_beat, uspq=uspq, tsDenominator=tsD)
+    calculateTiming(channels, pattern.ticks_per_beat, uspq=uspq, tsDenominator=tsD)
 
     #Just need the notes now, can drop all other information
     for i in range(len(channels)):
@@ -203,7 +260,15 @@ def processFile(filename, optimize=False, numChannels=2, printJSON=False, outFil
         print("NOTE: Pruned at least one empty channel")
 
     channels = insertRests(channels, resolution)
+
+    segments = calculateTempoMap(channels, tempoMap, uspq, resolution)
+    multiplier = segments[0][1]
+    print("Multiplier", multiplier)
+
+    channels, splits = insertTempoChanges(channels, segments, resolution)
     channels = splitLongNotes(channels, resolution)
+
+    reportTempoDrift(channels, tempoMap, uspq, multiplier, resolution, splits)
     channels = convertDurations(channels, resolution)
 
     doSanityChecks(channels)
@@ -211,6 +276,12 @@ def processFile(filename, optimize=False, numChannels=2, printJSON=False, outFil
     if optimize: 
         channels = doOptimize(channels)
 
+    if workload:
+        analyzeWorkload(channels, multiplier)
+
+    if sectors is not None:
+        sectors.append(layoutSectors(channels, multiplier, filename))
+
     printResult(channels, multiplier, filename, json=printJSON, outFile=outFile)
 
     if verbose > 2:
@@ -235,13 +306,13 @@ def processEvent(event, channels):
 
     elif event.is_meta and event.type == 'set_tempo': #set tempo event
         if noteEncountered:
-            tempo = ("TEMPO", event.time, event.time, event.tempo)
+            tempo = (event.time, event.tempo)
             if verbose > 2:
                 print("Tempo change:", tempo)
 
-            for channel in channels:
-                channel["Notes"].append(tempo)
-                tempoChanges = True
+            #Merged into every channel once the multipliers are known
+            channels[0].setdefault("TempoMap", []).append(tempo)
+            tempoChanges = True
         else:
             channels[0]["Tempo"] = event.tempo
             print("Tempo event, new uS/Q:", channels[0]["Tempo"])
@@ -270,6 +341,9 @@ def trimLeadingSilence(channels):
                 tempNotes.append(n)
             channel["Notes"] = tempNotes
 
+        if "TempoMap" in channels[0]:
+            channels[0]["TempoMap"] = [(t[0] - offset, t[1]) for t in channels[0]["TempoMap"]]
+
     if verbose > 2:
         print("\n")
         print(channels)
@@ -349,7 +423,6 @@ def calculateTiming(channels, patternResolution, uspq=500000, tsDenominator=4.0)
     SecondsPerTick = SecondsPerQuarterNote / patternResolution
 
     bpm = (60000000 / uspq) * (tsDenominator / 4.0)
-    multiplier = int(uspq/12000) #BASE quarter length is 12ms
 
     if verbose > 0:
         print("Tick Length (s)", SecondsPerTick)
@@ -358,11 +431,201 @@ def calculateTiming(channels, patternResolution, uspq=500000, tsDenominator=4.0)
         print("uS/Q", uspq)
 
     print("BPM", bpm)
-    print("Multiplier", multiplier)
 
     if verbose > 2:
         print("Exiting calculateTiming()\n")
-    return multiplier
+
+
+#(tick, real time in ms, uS/Q) at each tempo change, BASE quarter length is 12ms
+def tempoTimeline(changes, resolution):
+    timeline = []
+    time = 0.0
+    for i in range(len(changes)):
+        if i > 0:
+            time += (changes[i][0] - changes[i-1][0]) / float(resolution) * changes[i-1][1] / 12000.0
+        timeline.append((changes[i][0], time, changes[i][1]))
+    return timeline
+
+
+#Index of the tempo change in effect at tick
+def tempoIndex(timeline, tick):
+    return max(bisect.bisect_right(timeline, (tick, float("inf"))) - 1, 0)
+
+
+#Real time in ms at tick
+def idealTime(timeline, resolution, tick):
+    start, time, uspq = timeline[tempoIndex(timeline, tick)]
+    return time + (tick - start) / float(resolution) * uspq / 12000.0
+
+
+#Places every tempo change on one tick shared by all channels and picks one multiplier per tempo
+# segment, rounding up or down to pull back the error carried from earlier segments, returns
+# [(tick, multiplier)] holding only the ticks where the multiplier changes
+def calculateTempoMap(channels, tempoMap, uspq, resolution):
+    if verbose > 2:
+        print("Entering calculateTempoMap()")
+
+    length = max(channel[-1][2] for channel in channels)
+
+    #Constant tempo, a single multiplier and nothing to emit
+    if not any(tick < length for tick, tempo in tempoMap):
+        if verbose > 2:
+            print("Exiting calculateTempoMap()\n")
+        return [(0, min(max(int(uspq / (12000.0 * isr_tock) + 0.5), 1), 255))]
+
+    timeline = tempoTimeline([(0, uspq)] + tempoMap, resolution)
+
+    #Channels are contiguous after insertRests(), past its end a channel has no notes to split
+    starts = [[note[1] for note in channel] for channel in channels]
+    ends = [channel[-1][2] for channel in channels]
+    bounds = [set(s) | set([e]) for s, e in zip(starts, ends)]
+
+    #Notes a TEMPO at tick splits, None when a piece would be too short to encode
+    def splits(tick):
+        count = 0
+        for c in range(len(channels)):
+            if tick >= ends[c] or tick in bounds[c]:
+                continue
+            note = channels[c][bisect.bisect_right(starts[c], tick) - 1]
+            if tick - note[1] < 2*resolution or note[2] - tick < 2*resolution:
+                return None
+            count += 1
+        return count
+
+    #Nearest tick every channel can take the change on, fewest splits on ties
+    placements = set([0])
+    for tick, tempo in tempoMap:
+        if tick >= length:
+            continue
+
+        #Grid ticks and note boundaries within a whole note of the change
+        grid = int(resolution * round(float(tick)/resolution))
+        candidates = set(grid + k*resolution for k in range(-48, 49))
+        for c in range(len(channels)):
+            low = bisect.bisect_left(starts[c], tick - 48*resolution)
+            high = bisect.bisect_right(starts[c], tick + 48*resolution)
+            candidates.update(starts[c][low:high])
+
+        best = None
+        for candidate in candidates:
+            count = splits(candidate) if 0 <= candidate < length else None
+            if count is not None and (best is None or (abs(candidate - tick), count) < best[0]):
+                best = ((abs(candidate - tick), count), candidate)
+
+        if best is None:
+            print("WARNING: No room for tempo change at", tick, "splitting notes too short to encode")
+            best = (None, min(max(grid, 0), length - 1))
+
+        if verbose > 1:
+            print("Tempo change", (tick, tempo), "placed at", best[1])
+        placements.add(best[1])
+
+    ticks = sorted(placements) + [length]
+    segments = []
+    played = 0.0
+
+    for i in range(len(ticks) - 1):
+        units = (ticks[i+1] - ticks[i]) / float(resolution)
+        if units <= 0:
+            continue
+
+        #Floor or ceil of the exact multiplier, whichever ends the segment closest to real time
+        ideal = idealTime(timeline, resolution, ticks[i+1])
+        exact = (ideal - idealTime(timeline, resolution, ticks[i])) / (units * isr_tock)
+        options = [min(max(m, 1), 255) for m in (int(math.floor(exact)), int(math.ceil(exact)))]
+        multiplier = min(options, key=lambda m: abs(played + m * units * isr_tock - ideal))
+        played += multiplier * units * isr_tock
+
+        if not segments or segments[-1][1] != multiplier:
+            if verbose > 1:
+                print("Multiplier", multiplier, "from", ticks[i], "drift", played - ideal)
+            segments.append((ticks[i], multiplier))
+
+    if verbose > 2:
+        print("Exiting calculateTempoMap()\n")
+    return segments
+
+
+def insertTempoChanges(channels, segments, resolution):
+    if verbose > 2:
+        print("Entering insertTempoChanges()")
+
+    splits = 0
+    tempChannels = []
+    for channel in channels:
+        tempChannel = []
+        pending = list(segments[1:])
+
+        for note in channel:
+            while pending and pending[0][0] < note[2]:
+                tick, multiplier = pending.pop(0)
+
+                #Every channel takes the change on the same tick, split notes spanning it
+                if tick > note[1]:
+                    if verbose > 1:
+                        print("Splitting", note, "at tempo change", tick)
+                    tempChannel.append((note[0], note[1], tick))
+                    note = (note[0], tick, note[2])
+                    splits += 1
+
+                tempChannel.append(("TEMPO", tick, tick, multiplier))
+
+            tempChannel.append(note)
+        tempChannels.append(tempChannel)
+
+    if verbose > 2:
+        print("Exiting insertTempoChanges()\n")
+    return tempChannels, splits
+
+
+def reportTempoDrift(channels, tempoMap, uspq, multiplier, resolution, splits):
+    if verbose > 2:
+        print("Entering reportTempoDrift()")
+
+    timeline = tempoTimeline([(0, uspq)] + tempoMap, resolution)
+
+    drift = [0.0, 0.0]
+    truncatedDrift = [0.0, 0.0]
+    emitted = 0
+    #Tick -> time played in each channel, to see channels drifting apart
+    endTimes = collections.defaultdict(list)
+
+    for channel in channels:
+        played = 0.0
+        truncated = 0.0
+        current = multiplier
+        for note in channel:
+            if note[0] == "TEMPO":
+                current = note[3]
+                emitted += 1
+                continue
+
+            #What the converter used to emit, int(uS/Q / 12000) at every tempo event
+            tempo = timeline[tempoIndex(timeline, note[1])][2]
+
+            units = (note[2] - note[1]) / float(resolution)
+            played += current * units * isr_tock
+            truncated += int(tempo/12000) * units * isr_tock
+            endTimes[note[2]].append(played)
+
+            ideal = idealTime(timeline, resolution, note[2])
+            drift[0] = max(drift[0], abs(played - ideal))
+            truncatedDrift[0] = max(truncatedDrift[0], abs(truncated - ideal))
+
+        drift[1] = max(drift[1], abs(played - ideal))
+        truncatedDrift[1] = max(truncatedDrift[1], abs(truncated - ideal))
+
+    skew = max(max(times) - min(times) for times in endTimes.values())
+    #Against a TEMPO per change in every channel, each split note costs another note and duration
+    saved = 2 * len(channels) * len(tempoMap) - 2 * emitted - 2 * splits
+
+    print("Tempo map: {} changes, {} multiplier changes emitted, {} notes split, {} bytes saved".format(
+        len(tempoMap), emitted, splits, saved))
+    print("Timing drift: max {:.1f} ms, end {:.1f} ms, skew {:.1f} ms (truncated: max {:.1f} ms, end {:.1f} ms)".format(
+        drift[0], drift[1], skew, truncatedDrift[0], truncatedDrift[1]))
+
+    if verbose > 2:
+        print("Exiting reportTempoDrift()\n")
 
 
 def insertRests(channels, resolution):
@@ -389,11 +652,7 @@ def insertRests(channels, resolution):
                 restLength = int((w[1][1] - w[0][2])/resolution)*resolution #erode/dialate
 
                 n = ('NRS', w[1][1]-restLength, w[1][1])
-
-                if w[0][0] is not "TEMPO":
-                    t = (w[0][0], w[0][1], n[1])
-                else:
-                    t = w[0]
+                t = (w[0][0], w[0][1], n[1])
 
                 tempChannel.append(t)
                 tempChannel.append(n)
@@ -403,10 +662,7 @@ def insertRests(channels, resolution):
                     print(n)
 
             else:
-                if w[0][0] is not "TEMPO":
-                    t = (w[0][0], w[0][1], w[1][1])
-                else:
-                    t = (w[0][0], w[0][1], w[1][1], w[0][3])
+                t = (w[0][0], w[0][1], w[1][1])
                 tempChannel.append(t)
 
                 if verbose > 2:
@@ -447,7 +703,10 @@ def doOptimize(channels):
         tempDuration = ''
         songBytes += 2*len(channel)
         for note in channel:
-            if tempDuration == note[1]:
+            if note[0] == "TEMPO":
+                #Endpoint keeps its duration across a TEMPO
+                tempChannel.append(note)
+            elif tempDuration == note[1]:
                 tempChannel.append((note[0] , ''))
                 songSaved += 1
             else:
@@ -554,8 +813,7 @@ def convertDurations(channels, resolution):
             if note[0] is not "TEMPO":
                 newNote = (note[0], duration_strings[ind])
             else:
-                #BASE quarter length is 12ms
-                newNote = (note[0], str(int(note[3]/12000)))
+                newNote = (note[0], str(note[3]))
 
             if verbose > 2:
                 print(note, note[2]-note[1], ind, "->", newNote)
@@ -635,6 +893,284 @@ def doSanityChecks(channels):
     if verbose > 2:
         print("Exiting doSanityChecks()\n")
 
+#Byte stream exactly as CAudio sees it through StreamFunc
+def encodeChannel(channel, multiplier):
+    stream = [multiplier]
+    for note in channel:
+        stream.append(value_dict[note[0]])
+        if note[0] == "TEMPO":
+            stream.append(int(note[1]))
+        elif note[1] != '':
+            stream.append(value_dict[note[1]])
+    stream.append(value_dict["END"])
+    return stream
+
+#Replays Endpoint::next() over a byte stream, returns the work done by every next() fired from
+# tock() as (ms, nexts, reads, pgmReads, multiplies, divides), the ms the endpoint stops and the
+# ms each offset of the stream is first read at
+def simulateEndpoint(stream):
+    END = value_dict["END"]
+    TEMPO = value_dict["TEMPO"]
+
+    multiplier = stream[0]
+    duration = value_dict["DQ"]
+    index = 1
+    time = 0
+    events = []
+    firstRead = [0] #assign() reads the multiplier
+
+    def read(offset):
+        if offset == len(firstRead) and offset < len(stream):
+            firstRead.append(time)
+        return stream[offset] if offset < len(stream) else END
+
+    while True:
+        nexts = reads = pgmReads = multiplies = divides = 0
+        length = None
+
+        while True:
+            nexts += 1
+            reads += 1
+            note = read(index)
+
+            if note < END:
+                reads += 1 #Look ahead
+                if read(index + 1) > TEMPO:
+                    duration = stream[index + 1]
+                    index += 2
+                else:
+                    index += 1
+
+                pgmReads += 2
+                multiplies += 1
+                divides += 1
+                #ms_remaining is decremented before the check so 0 wraps around
+                length = (multiplier * duration_units[duration - TEMPO - 1]) or 65536
+                break
+            elif note == TEMPO:
+                reads += 1
+                multiplier = read(index + 1)
+                index += 2
+            else:
+                break
+
+        #The first next() happens in Play(), outside of the interrupt
+        if time > 0:
+            events.append((time, nexts, reads, pgmReads, multiplies, divides))
+
+        if length is None:
+            return events, time, firstRead
+
+        time += length
+
+def analyzeWorkload(channels, multiplier):
+    global workloadFailures
+
+    if verbose > 2:
+        print("Entering analyzeWorkload()")
+
+    streams = [encodeChannel(channel, multiplier) for channel in channels]
+
+    if len(streams) > isr_endpoints:
+        print("WARNING: CAudio only drives", isr_endpoints, "endpoints, ignoring the rest")
+        streams = streams[:isr_endpoints]
+
+    budget = isr_cpu // isr_frequency
+    baseCycles = isr_cycles["Overhead"] + isr_endpoints * (isr_cycles["Tick"] + isr_cycles["Tock"])
+
+    #ms -> [nexts, reads, cycles]
+    ticks = {}
+    length = 0
+
+    for stream in streams:
+        events, end, _ = simulateEndpoint(stream)
+        length = max(length, end)
+
+        for time, nexts, reads, pgmReads, multiplies, divides in events:
+            tick = ticks.setdefault(time, [0, 0, baseCycles])
+            tick[0] += nexts
+            tick[1] += reads
+            tick[2] += (nexts * isr_cycles["Next"] + reads * isr_cycles["StreamRead"] +
+                        pgmReads * isr_cycles["PgmRead"] + multiplies * isr_cycles["Multiply"] +
+                        divides * isr_cycles["Divide"])
+
+    idle = length - len(ticks)
+    nextCounts = collections.Counter(tick[0] for tick in ticks.values())
+    readCounts = collections.Counter(tick[1] for tick in ticks.values())
+    #Number of timer periods the millisecond interrupt occupies
+    periodCounts = collections.Counter((tick[2] + budget - 1) // budget for tick in ticks.values())
+    nextCounts[0] += idle
+    readCounts[0] += idle
+    periodCounts[(baseCycles + budget - 1) // budget] += idle
+
+    peakTime, peak = max(ticks.items(), key=lambda x: (x[1][2], -x[0])) if ticks else (0, [0, 0, baseCycles])
+
+    print("ISR workload ({} MHz, {} cycles/interrupt, {} ms):".format(isr_cpu / 1000000.0, budget, length))
+    print("    next() per tick:", dict(sorted(nextCounts.items())))
+    print("    Stream reads per tick:", dict(sorted(readCounts.items())))
+    print("    Interrupt periods per tick:", dict(sorted(periodCounts.items())))
+    print("    Peak: {} next(), {} reads, ~{} cycles ({:.2f}x budget) at {} ms".format(
+        peak[0], peak[1], peak[2], float(peak[2]) / budget, peakTime))
+
+    #The compare flag latches a single pending match, every further period spent in the ISR drops one
+    flagged = sorted((time, tick[2] // budget - 1) for time, tick in ticks.items() if tick[2] >= 2 * budget)
+    passages = []
+    for time, dropped in flagged:
+        if passages and time - passages[-1][1] <= isr_passage_gap:
+            passages[-1][1] = time
+            passages[-1][2] += 1
+            passages[-1][3] += dropped
+        else:
+            passages.append([time, time, 1, dropped])
+
+    dropped = sum(p[3] for p in passages)
+
+    if passages:
+        fmtString = "WARNING: {} ticks in {} passages risk overrunning the interrupt budget ({} timer matches dropped)"
+        print(fmtString.format(len(flagged), len(passages), dropped))
+
+        #Worst passages first, only list them all when asked to
+        passages.sort(key=lambda x: (-x[3], x[0]))
+        for start, stop, count, matches in passages[:None if verbose > 0 else isr_passage_limit]:
+            print("    {} ms - {} ms: {} ticks, {} dropped".format(start, stop, count, matches))
+
+    if isr_max_dropped is not None and dropped > isr_max_dropped:
+        workloadFailures += 1
+
+    if verbose > 2:
+        print("Exiting analyzeWorkload()\n")
+
+def layoutSectors(channels, multiplier, filename):
+    if verbose > 2:
+        print("Entering layoutSectors()")
+
+    streams = [encodeChannel(channel, multiplier) for channel in channels]
+
+    if len(streams) > isr_endpoints:
+        print("WARNING: CBlockStream only drives", isr_endpoints, "endpoints")
+
+    #Each sector starts with a uint16 segment length per channel
+    capacity = sector_size - 2 * len(streams)
+
+    reads = []
+    length = 0
+    for channel, stream in enumerate(streams):
+        _, end, firstRead = simulateEndpoint(stream)
+        length = max(length, end)
+        reads.extend((time, channel, offset) for offset, time in enumerate(firstRead))
+    reads.sort()
+
+    blocks = []
+    block = None
+    i = 0
+    while i < len(reads):
+        #Bytes first read on the same ms stay together whenever they fit
+        j = i
+        while j < len(reads) and reads[j][0] == reads[i][0]:
+            j += 1
+
+        if block and block["Size"] + (j - i) > capacity:
+            block = None
+
+        for time, channel, offset in reads[i:j]:
+            if not block or block["Size"] == capacity:
+                block = {"Start": time, "Stop": time, "Size": 0, "Segments": [None] * len(streams)}
+                blocks.append(block)
+
+            if block["Segments"][channel] is None:
+                block["Segments"][channel] = [offset, 0]
+            block["Segments"][channel][1] += 1
+            block["Stop"] = time
+            block["Size"] += 1
+        i = j
+
+    simulateSectors(blocks, length)
+
+    if verbose > 2:
+        print("Exiting layoutSectors()\n")
+
+    return {"Name": os.path.splitext(os.path.basename(filename))[0], "Streams": streams, "Blocks": blocks}
+
+#Replays the refills CBlockStream::Service() does for the given layout
+def simulateSectors(blocks, length):
+    if verbose > 2:
+        print("Entering simulateSectors()")
+
+    #A buffer frees up once the last byte of its block is read, blocks are loaded one at a time
+    def underruns(buffers):
+        count = 0
+        loaded = 0.0
+        for k in range(buffers, len(blocks)):
+            loaded = max(blocks[k - buffers]["Stop"], loaded) + sector_latency
+            if loaded > blocks[k]["Start"]:
+                count += 1
+        return count
+
+    buffers = 1
+    while buffers < len(blocks) and underruns(buffers):
+        buffers += 1
+
+    peak = 0
+    first = 0
+    for k in range(len(blocks)):
+        while blocks[k]["Start"] - blocks[first]["Start"] >= 1000:
+            first += 1
+        peak = max(peak, k - first + 1)
+
+    windows = [blocks[k+1]["Start"] - blocks[k]["Start"] for k in range(len(blocks) - 1)]
+    padding = sum(sector_size - 2 * len(b["Segments"]) - b["Size"] for b in blocks)
+
+    print("SD layout: {} blocks ({} bytes, {} padding)".format(len(blocks), len(blocks) * sector_size, padding))
+    print("Block reads: {:.2f}/s average, {} peak in 1 s, shortest window {} ms".format(
+        len(blocks) * 1000.0 / max(length, 1), peak, min(windows) if windows else length))
+    print("Buffers needed at {} ms latency: {} ({} bytes)".format(sector_latency, buffers, buffers * sector_size))
+
+    if buffers > sector_buffers:
+        print("WARNING: {} buffers will underrun {} times".format(sector_buffers, underruns(sector_buffers)))
+
+    if verbose > 2:
+        print("Exiting simulateSectors()\n")
+
+#Directory of (first sector, sector count, channel count) per song followed by the songs, see nBlockStream.h
+def writeSectors(songs, filename):
+    if verbose > 2:
+        print("Entering writeSectors()")
+
+    directory = bytearray(sector_magic) + struct.pack('<BBH', sector_version, 0, len(songs))
+    first = (len(directory) + 8 * len(songs) + sector_size - 1) // sector_size
+
+    data = bytearray()
+    for song in songs:
+        if len(song["Blocks"]) > 0xFFFF:
+            raise ValueError("Too many sectors in " + song["Name"])
+
+        directory += struct.pack('<IHBB', first, len(song["Blocks"]), len(song["Streams"]), 0)
+        first += len(song["Blocks"])
+
+        for block in song["Blocks"]:
+            sector = bytearray()
+            payload = bytearray()
+            for stream, segment in zip(song["Streams"], block["Segments"]):
+                offset, count = segment or (0, 0)
+                #Top bit marks the segment holding the end of the channel
+                last = 0x8000 if count and offset + count == len(stream) else 0
+                sector += struct.pack('<H', count | last)
+                payload += bytearray(stream[offset:offset + count])
+            sector += payload
+            data += sector + bytearray(sector_size - len(sector))
+
+    directory += bytearray(-len(directory) % sector_size)
+
+    with open(filename, 'wb') as f:
+        f.write(directory + data)
+
+    print("Wrote {} songs ({} bytes) to {}".format(len(songs), len(directory) + len(data), filename))
+    for i, song in enumerate(songs):
+        print("    {}: {}".format(i, song["Name"]))
+
+    if verbose > 2:
+        print("Exiting writeSectors()\n")
+
 def printResult(channels, multiplier, filename, json=False, outFile=None):
     print("\n")
     if not outFile:
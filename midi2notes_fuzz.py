@@ -0,0 +1,266 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+import argparse, os, sys, random, shutil, subprocess, tempfile, types, difflib, fractions, traceback
+import mido
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+from timeit import default_timer
+
+
+#Revision whose output every candidate is diffed against, move it (and say why in the commit)
+# only when the output is meant to change
+reference_revision = '8389220a0632444666e5b8fcc9d0976dd2347014'
+
+verbose = 0
+
+def main():
+    global verbose
+
+    parser = argparse.ArgumentParser(description='Diff midi2notes output against a frozen reference on fuzzed midi files.')
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    parser.add_argument('-r', '--reference', default=reference_revision,
+                        help='Reference midi2notes.py, either a path or a git revision (default {})'.format(reference_revision[:7]))
+    parser.add_argument('-C', '--candidate', default=os.path.join(directory, 'midi2notes.py'),
+                        help='Candidate midi2notes.py (default the working copy)')
+    parser.add_argument('-n', '--count', type=int, default=200, help='Number of midi files to generate')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the first midi file')
+    parser.add_argument('-k', '--keep', help='Directory to copy mismatching midi files to')
+    parser.add_argument("-v", "--verbosity", action="count", default=0, help='Each use increases verbosity level')
+
+    args = parser.parse_args()
+
+    verbose = args.verbosity
+
+    if verbose > 0:
+        print(args)
+
+    reference = loadPipeline(args.reference, 'midi2notes_reference')
+    candidate = loadPipeline(args.candidate, 'midi2notes_candidate')
+
+    results = runCases(reference, candidate, args.count, args.seed, keep=args.keep)
+
+    printReport(results)
+
+    if results["Mismatched"]:
+        sys.exit(1)
+
+
+#Loads midi2notes.py from a path or git revision as a standalone module
+def loadPipeline(source, name):
+    if os.path.isfile(source):
+        with open(source) as f:
+            code = f.read()
+    else:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        code = subprocess.check_output(['git', 'show', source + ':./midi2notes.py'], cwd=directory)
+        code = code.decode('utf-8')
+
+    #Older revisions import gcd from fractions, which Python 3.9 dropped
+    if not hasattr(fractions, 'gcd'):
+        code = code.replace('from fractions import gcd', 'from math import gcd')
+
+    module = types.ModuleType(name)
+    module.__file__ = source
+    exec(compile(code, source, 'exec'), module.__dict__)
+    return module
+
+
+#Random midi exercising the awkward corners of the converter, returns the number of notes and
+# the most notes sounding at once
+def generateMidi(rng, filename):
+    tpb = rng.choice([96, 120, 192, 240, 384, 480, 960])
+    resolution = tpb // 12
+
+    pattern = mido.MidiFile(type=1, ticks_per_beat=tpb)
+    events = []
+
+    #Conductor track, tempo and time signature changes
+    conductor = []
+    if rng.random() < 0.8:
+        conductor.append((0, mido.MetaMessage('set_tempo', tempo=rng.randint(200000, 1200000))))
+    if rng.random() < 0.5:
+        conductor.append((0, mido.MetaMessage('time_signature', numerator=rng.choice([2, 3, 4, 6, 7]),
+                                              denominator=rng.choice([2, 4, 8]))))
+    events.append(conductor)
+
+    numTracks = rng.choice([1, 1, 2, 3, 4, rng.randint(5, 16)])
+    numNotes = 0
+    length = 0
+    #(tick, +1/-1) of every note, offs sort before ons on the same tick like the converter
+    sounding = []
+
+    for t in range(numTracks):
+        track = []
+        time = rng.randint(0, 4) * resolution * 3
+        for n in range(rng.randint(1, 64)):
+            roll = rng.random()
+            if roll < 0.6:
+                #Regular durations
+                duration = resolution * rng.choice([2, 3, 4, 6, 8, 9, 12, 16, 18, 24, 36, 48])
+            elif roll < 0.8:
+                #Odd durations
+                duration = resolution * rng.randint(2, 60) + rng.choice([0, 0, 1, -1, resolution // 2])
+            else:
+                #Very long durations
+                duration = resolution * rng.randint(49, 400)
+            duration = max(duration, 1)
+
+            pitch = rng.randint(24, 107)
+            velocity = rng.randint(1, 127)
+            track.append((time, mido.Message('note_on', note=pitch, velocity=velocity)))
+
+            #Zero velocity note on and note off are both used as note off
+            if rng.random() < 0.5:
+                off = mido.Message('note_on', note=pitch, velocity=0)
+            else:
+                off = mido.Message('note_off', note=pitch, velocity=rng.randint(0, 127))
+            track.append((time + duration, off))
+            sounding.extend([(time, 1), (time + duration, -1)])
+            numNotes += 1
+
+            #Overlap, touch or leave a gap before the next note
+            roll = rng.random()
+            if roll < 0.2:
+                time += rng.randint(0, duration)
+            elif roll < 0.8:
+                time += duration
+            else:
+                time += duration + resolution * rng.randint(1, 60)
+        length = max(length, time)
+        events.append(track)
+
+    for c in range(rng.randint(0, 6)):
+        tick = rng.randint(0, max(length, 1))
+        if rng.random() < 0.5:
+            tick -= tick % resolution
+        if rng.random() < 0.7:
+            conductor.append((tick, mido.MetaMessage('set_tempo', tempo=rng.randint(200000, 1200000))))
+        else:
+            conductor.append((tick, mido.MetaMessage('time_signature', numerator=rng.choice([2, 3, 4, 6]),
+                                                     denominator=rng.choice([2, 4, 8]))))
+
+    for track in events:
+        midiTrack = mido.MidiTrack()
+        previous = 0
+        for time, msg in sorted(track, key=lambda x: x[0]):
+            midiTrack.append(msg.copy(time=time - previous))
+            previous = time
+        pattern.tracks.append(midiTrack)
+
+    pattern.save(filename)
+
+    polyphony = 0
+    count = 0
+    for tick, change in sorted(sounding):
+        count += change
+        polyphony = max(polyphony, count)
+
+    return numNotes, polyphony
+
+
+#Runs one file through a pipeline, returns the emitted output (or the exception type, message and
+# raising function) and seconds taken
+def runPipeline(pipeline, filename, options):
+    outFile = StringIO()
+    stdout = sys.stdout
+    sys.stdout = StringIO() #Chatter is not part of the output
+    start = default_timer()
+    try:
+        pipeline.processFile(filename, outFile=outFile, printJSON=True, **options)
+        result = outFile.getvalue()
+    except Exception as e:
+        #Only the same crash from the same function counts as matching
+        result = (type(e).__name__, str(e), traceback.extract_tb(sys.exc_info()[2])[-1][2])
+    finally:
+        elapsed = default_timer() - start
+        sys.stdout = stdout
+    return result, elapsed
+
+
+def runCases(reference, candidate, count, seed, keep=None):
+    results = {
+        "Cases": 0,
+        "Matched": 0,
+        "Mismatched": 0,
+        "Crashed": 0,
+        "Notes": 0,
+        "ReferenceTime": 0.0,
+        "CandidateTime": 0.0,
+    }
+
+    directory = tempfile.mkdtemp(prefix='midi2notes_fuzz')
+
+    try:
+        for case in range(seed, seed + count):
+            rng = random.Random(case)
+            filename = os.path.join(directory, 'fuzz_{}.mid'.format(case))
+            notes, polyphony = generateMidi(rng, filename)
+            #More channels than notes ever sound at once leaves one empty, which the converter rejects
+            options = {"optimize": rng.random() < 0.5, "numChannels": rng.randint(1, max(1, min(4, polyphony)))}
+
+            expected, referenceTime = runPipeline(reference, filename, options)
+            actual, candidateTime = runPipeline(candidate, filename, options)
+
+            results["Cases"] += 1
+            results["Notes"] += notes
+            results["ReferenceTime"] += referenceTime
+            results["CandidateTime"] += candidateTime
+
+            if expected == actual:
+                if isinstance(expected, tuple):
+                    results["Crashed"] += 1
+                    if verbose > 0:
+                        print("Seed", case, options, "raised {} in {}() in both".format(expected[0], expected[2]))
+                else:
+                    results["Matched"] += 1
+                    if verbose > 1:
+                        print("Seed", case, options, "matched")
+                continue
+
+            results["Mismatched"] += 1
+            print("MISMATCH: seed", case, options)
+            printDifference(expected, actual)
+
+            if keep:
+                if not os.path.isdir(keep):
+                    os.makedirs(keep)
+                shutil.copy(filename, keep)
+    finally:
+        shutil.rmtree(directory)
+
+    return results
+
+
+def printDifference(expected, actual):
+    if isinstance(expected, tuple) or isinstance(actual, tuple):
+        for name, result in [("reference", expected), ("candidate", actual)]:
+            if isinstance(result, tuple):
+                print("    {}: raised {}({!r}) in {}()".format(name, result[0], result[1][:200], result[2]))
+            else:
+                print("    {}: {!r}".format(name, result[:200]))
+        return
+
+    diff = list(difflib.unified_diff(expected.splitlines(), actual.splitlines(),
+                                     'reference', 'candidate', lineterm=''))
+    for line in diff[:None if verbose > 0 else 20]:
+        print("    " + line)
+
+
+def printReport(results):
+    print("Cases: {}, matched: {}, mismatched: {}, crashed in both: {}".format(
+        results["Cases"], results["Matched"], results["Mismatched"], results["Crashed"]))
+
+    for name in ["Reference", "Candidate"]:
+        elapsed = results[name + "Time"]
+        fmtString = "{}: {:.3f} s, {:.1f} files/s, {:.0f} notes/s"
+        print(fmtString.format(name, elapsed, results["Cases"] / elapsed, results["Notes"] / elapsed))
+
+    print("Speedup: {:.2f}x".format(results["ReferenceTime"] / results["CandidateTime"]))
+
+
+if __name__ == "__main__":
+    main()
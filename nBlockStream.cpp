@@ -0,0 +1,276 @@
+/*
+ * Copyright (c) 2026 nAudio contributors
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a
+ * copy of this software and associated documentation files (the "Software"),
+ * to deal in the Software without restriction, including without limitation
+ * the rights to use, copy, modify, merge, publish, distribute, sublicense,
+ * and/or sell copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following conditions:
+ * The above copyright notice and this permission notice shall be included in
+ * all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ * IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ * FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ * AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ * LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+ * IN THE SOFTWARE.
+ *
+ * @file        nBlockStream.cpp
+ * @summary     Double buffered StreamFunc for songs stored on SD card
+ * @version     1.0
+ * @author      nAudio contributors
+ * @data        19 October 2026
+ */
+
+#include "nBlockStream.h"
+
+static inline uint16_t read_uint16(const uint8_t* data)
+{
+    return data[0] | (data[1] << 8);
+}
+
+CBlockStream::CBlockStream(ReadFunc read, void* context)
+{
+    this->read = read;
+    read_context = context;
+    block_count = 0;
+    next_block = 0;
+    header_size = 0;
+    channel_count = 0;
+    underrun_count = 0;
+
+    for (uint8_t index = 0; index < BUFFER_COUNT; index++)
+    {
+        loaded[index] = NONE;
+    }
+}
+
+bool CBlockStream::Open(uint16_t song)
+{
+    uint32_t position = 8 + (uint32_t) song * 8; // Directory entry
+
+    block_count = 0;
+    next_block = 0;
+    channel_count = 0;
+    underrun_count = 0;
+
+    for (uint8_t index = 0; index < BUFFER_COUNT; index++)
+    {
+        loaded[index] = NONE;
+    }
+
+    if (!read(0, buffer[0], read_context)
+        || memcmp(buffer[0], "nAUD", 4) != 0
+        || buffer[0][4] != 1
+        || song >= read_uint16(&buffer[0][6]))
+    {
+        return false;
+    }
+
+    // Entries never straddle sectors
+    if (position >= BLOCK_SIZE && !read(position / BLOCK_SIZE, buffer[0], read_context))
+    {
+        return false;
+    }
+
+    const uint8_t* entry = &buffer[0][position % BLOCK_SIZE];
+    first_block = read_uint16(&entry[0]) | ((uint32_t) read_uint16(&entry[2]) << 16);
+    block_count = read_uint16(&entry[4]);
+    header_size = entry[6] * 2;
+    channel_count = entry[6];
+
+    if (channel_count > COUNT)
+    {
+        channel_count = COUNT;
+    }
+
+    for (uint8_t index = 0; index < COUNT; index++)
+    {
+        Channel* c = &channel[index];
+        c->owner = this;
+        c->index = index;
+        c->last = false;
+        c->done = (index >= channel_count);
+        c->block = NONE; // First read wraps around to sector 0
+        c->base = 0;
+        c->length = 0;
+        c->start = 0;
+        c->cache_offset = NONE;
+        c->cache_value = 0;
+    }
+
+    // Fill every buffer before playback starts
+    for (uint8_t index = 0; index < BUFFER_COUNT && next_block < block_count; index++)
+    {
+        if (!read(first_block + next_block, buffer[index], read_context))
+        {
+            return false;
+        }
+
+        loaded[index] = next_block++;
+    }
+
+    return true;
+}
+
+void CBlockStream::Service(void)
+{
+    if (next_block >= block_count)
+    {
+        return;
+    }
+
+    uint8_t free = BUFFER_COUNT;
+
+    noInterrupts();
+
+    uint16_t needed = Needed();
+
+    for (uint8_t index = 0; index < BUFFER_COUNT; index++)
+    {
+        if (loaded[index] == NONE || loaded[index] < needed)
+        {
+            loaded[index] = NONE; // Released, Stream() can no longer find it
+            free = index;
+            break;
+        }
+    }
+
+    interrupts();
+
+    // One sector per call to keep loop() responsive
+    if (free < BUFFER_COUNT && read(first_block + next_block, buffer[free], read_context))
+    {
+        noInterrupts();
+        loaded[free] = next_block++;
+        interrupts();
+    }
+}
+
+uint8_t CBlockStream::Stream(uint16_t offset, void* context)
+{
+    Channel* c = (Channel*) context;
+    CBlockStream* owner = c->owner;
+
+    if (offset == c->cache_offset)
+    {
+        return c->cache_value; // Look ahead being read again
+    }
+
+    if (c->done)
+    {
+        return NOTE::END;
+    }
+
+    // Move forward to the segment holding offset
+    while (offset >= c->base + c->length)
+    {
+        if (c->last || !owner->Enter(c, c->block + 1))
+        {
+            c->done = true; // Releases the sector for the other channels
+            return NOTE::END;
+        }
+    }
+
+    const uint8_t* data = owner->Find(c->block);
+
+    if (data == nullptr)
+    {
+        owner->underrun_count++;
+        c->done = true;
+        return NOTE::END;
+    }
+
+    c->cache_offset = offset;
+    c->cache_value = data[c->start + offset - c->base];
+
+    if (c->last && offset == c->base + c->length - 1)
+    {
+        c->done = true;
+    }
+
+    return c->cache_value;
+}
+
+const uint8_t* CBlockStream::Find(uint16_t block)
+{
+    for (uint8_t index = 0; index < BUFFER_COUNT; index++)
+    {
+        if (loaded[index] == block)
+        {
+            return buffer[index];
+        }
+    }
+
+    return nullptr;
+}
+
+bool CBlockStream::Enter(Channel* c, uint16_t block)
+{
+    const uint8_t* data = Find(block);
+
+    if (data == nullptr)
+    {
+        underrun_count++;
+        return false;
+    }
+
+    uint16_t start = header_size;
+
+    for (uint8_t index = 0; index < c->index; index++)
+    {
+        start += read_uint16(&data[index * 2]) & 0x7FFF;
+    }
+
+    uint16_t length = read_uint16(&data[c->index * 2]);
+
+    c->base += c->length;
+    c->length = length & 0x7FFF;
+    c->last = length & 0x8000;
+    c->start = start;
+    c->block = block;
+
+    return true;
+}
+
+// Lowest song sector any channel still has to read from, call with interrupts disabled
+uint16_t CBlockStream::Needed(void)
+{
+    uint16_t needed = NONE;
+
+    for (uint8_t index = 0; index < channel_count; index++)
+    {
+        Channel* c = &channel[index];
+
+        if (c->done)
+        {
+            continue;
+        }
+
+        uint16_t block = c->block;
+
+        if ((uint16_t) (c->cache_offset + 1) >= c->base + c->length)
+        {
+            block++; // Current segment fully read
+
+            // Step over sectors holding nothing for this channel so they do not hold up the rest
+            const uint8_t* data;
+            while (block < block_count
+                   && (data = Find(block)) != nullptr
+                   && (read_uint16(&data[index * 2]) & 0x7FFF) == 0)
+            {
+                Enter(c, block++);
+            }
+        }
+
+        if (block < needed)
+        {
+            needed = block;
+        }
+    }
+
+    return needed;
+}
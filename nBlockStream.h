@@ -0,0 +1,124 @@
+/*
+ * Copyright (c) 2026 nAudio contributors
+ *
+ * Permission is hereby granted, free of charge, to any person obtaining a
+ * copy of this software and associated documentation files (the "Software"),
+ * to deal in the Software without restriction, including without limitation
+ * the rights to use, copy, modify, merge, publish, distribute, sublicense,
+ * and/or sell copies of the Software, and to permit persons to whom the
+ * Software is furnished to do so, subject to the following conditions:
+ * The above copyright notice and this permission notice shall be included in
+ * all copies or substantial portions of the Software.
+ *
+ * THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+ * IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+ * FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+ * AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+ * LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+ * FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+ * IN THE SOFTWARE.
+ *
+ * @file        nBlockStream.h
+ * @summary     Double buffered StreamFunc for songs stored on SD card
+ * @version     1.0
+ * @author      nAudio contributors
+ * @data        19 October 2026
+ */
+
+#ifndef _BLOCKSTREAM_H_
+#define _BLOCKSTREAM_H_
+
+#include <Arduino.h>
+#include <inttypes.h>
+#include "nAudio.h"
+
+/*
+ * Container written by midi2notes.py -S, all values little endian
+ *
+ * Sector 0..n: "nAUD", version, reserved, uint16 song count, then per song
+ *              uint32 first sector, uint16 sector count, uint8 channel count, reserved
+ * Song sector: uint16 segment length per channel (top bit set on the segment
+ *              holding the END of that channel), then the segments back to back
+ *
+ * Segments are packed in the order playback first reads them, so every sector
+ * feeds all channels for a stretch of time and sectors are read in sequence.
+ *
+ * An underrun (a sector not loaded by the time playback reads it) ends the
+ * channel: Stream() returns END from then on and CAudio stops the endpoint.
+ * CAudio advances through the stream by the values it reads, so there is no
+ * way to stall. GetUnderrunCount() tells an underrun from a clean end.
+ *
+ * Usage:
+ *     block_stream.Open(song);
+ *     audio.Play(CBlockStream::Stream, block_stream.GetContext(0), block_stream.GetContext(1));
+ *     while (audio.IsActive()) { block_stream.Service(); }
+ */
+
+class CBlockStream
+{
+    public:
+    static const uint16_t BLOCK_SIZE = 512;
+    static const uint8_t BUFFER_COUNT = 2;
+    static const uint8_t COUNT = 3; // Matches CAudio endpoints
+
+    typedef bool (*ReadFunc)(uint32_t, uint8_t*, void*); // Read sector into buffer
+
+    struct Channel
+    {
+        CBlockStream* owner;
+        uint8_t index;
+        bool last;              // Current segment holds the END
+        bool done;              // END was read or an underrun ended the channel
+        uint16_t block;         // Song sector of the current segment
+        uint16_t base;          // Stream offset of the current segment
+        uint16_t length;        // Length of the current segment
+        uint16_t start;         // Sector offset of the current segment
+        uint16_t cache_offset;  // next() only ever re-reads the highest offset
+        uint8_t cache_value;
+    };
+
+    CBlockStream(ReadFunc read, void* context = nullptr);
+
+    bool Open(uint16_t song); // Blocking, fills every buffer
+    void Service(void); // Call from loop(), refills released buffers
+
+    inline uint8_t GetChannelCount(void) __attribute__((always_inline))
+    {
+        return channel_count;
+    };
+
+    inline Channel* GetContext(uint8_t index) __attribute__((always_inline))
+    {
+        return &channel[index];
+    };
+
+    inline uint16_t GetUnderrunCount(void) __attribute__((always_inline))
+    {
+        return underrun_count;
+    };
+
+    static uint8_t Stream(uint16_t offset, void* context);
+
+    private:
+
+    static const uint16_t NONE = 0xFFFF;
+
+    ReadFunc read;
+    void* read_context;
+
+    uint8_t buffer[BUFFER_COUNT][BLOCK_SIZE];
+    volatile uint16_t loaded[BUFFER_COUNT]; // Song sector held by each buffer
+    uint32_t first_block;
+    uint16_t block_count;
+    uint16_t next_block; // Next song sector to load
+    uint16_t header_size; // Segment lengths of every channel in the song
+    uint8_t channel_count;
+    volatile uint16_t underrun_count;
+    Channel channel[COUNT];
+
+    const uint8_t* Find(uint16_t block);
+    bool Enter(Channel* c, uint16_t block);
+    uint16_t Needed(void);
+};
+
+#endif